@@ -0,0 +1,15 @@
+import os
+import platform
+import tempfile
+
+import pytest
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # the generated images are big and /tmp is a (small) tmpfs on many
+    # systems, so let pytest create its numbered pytest-of-<user> tmp
+    # dirs in /var/tmp instead unless the user picked a $TMPDIR. Not done
+    # on macOS as /var/tmp is not shared with the podman machine.
+    if platform.system() == "Linux" and "TMPDIR" not in os.environ:
+        tempfile.tempdir = "/var/tmp"
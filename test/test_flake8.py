@@ -1,11 +1,25 @@
+import hashlib
 import os
 import pathlib
 import subprocess
 
+import pytest
 
-def test_flake8():
+# TODO: use all static checks from osbuild instead
+FLAKE8_CMD = ["flake8", "--jobs=auto", "--ignore=E402", "--max-line-length=120"]
+
+
+def test_flake8(pytestconfig):
     p = pathlib.Path(__file__).parent
-    # TODO: use all static checks from osbuild instead
-    subprocess.check_call(
-        ["flake8", "--ignore=E402", "--max-line-length=120",
-         os.fspath(p)])
+    # only check files that changed since the last clean run with the
+    # same flake8 arguments, use "pytest --cache-clear" to force a full
+    # check. Without the cacheprovider plugin everything is checked.
+    cache = getattr(pytestconfig, "cache", None)
+    cache_key = "flake8/last_mtime-" + hashlib.sha256(" ".join(FLAKE8_CMD).encode()).hexdigest()[:12]
+    last_mtime = cache.get(cache_key, 0) if cache is not None else 0
+    changed = [f for f in p.rglob("*.py") if f.stat().st_mtime > last_mtime]
+    if not changed:
+        pytest.skip("no files changed since last clean flake8 run")
+    subprocess.check_call([*FLAKE8_CMD, *[os.fspath(f) for f in changed]])
+    if cache is not None:
+        cache.set(cache_key, max(f.stat().st_mtime for f in changed))
@@ -4,7 +4,8 @@ import pathlib
 import platform
 import re
 import subprocess
-from typing import NamedTuple
+import uuid
+from dataclasses import dataclass
 
 import pytest
 
@@ -24,31 +25,87 @@ if platform.system() == "Linux" and platform.machine() == "x86_64" and not testu
     pytest.skip("need x86_64-v3 capable CPU", allow_module_level=True)
 
 
+def remove_stale_test_containers(keep):
+    """Remove all bootc-image-builder-test:* images except keep"""
+    images = subprocess.check_output([
+        "podman", "images", "--noheading",
+        "--format", "{{.Repository}}:{{.Tag}}",
+        "--filter", "reference=bootc-image-builder-test",
+    ], encoding="utf-8").split()
+    stale = [img for img in images if not img.endswith(f"/{keep}") and img != keep]
+    if stale:
+        subprocess.run(["podman", "rmi", *stale], check=False, stdout=subprocess.DEVNULL)
+
+
 @pytest.fixture(name="build_container", scope="session")
 def build_container_fixture():
     """Build a container from the Containerfile and returns the name"""
-    container_tag = "bootc-image-builder-test"
-    subprocess.check_call([
+    # tag by content, with BIB_TEST_REUSE_CONTAINER set an existing image
+    # for an unchanged tree is used as is. This does not notice updates
+    # of the base image or of the osbuild packages, so it is opt-in.
+    digest = testutil.container_build_digest("Containerfile")
+    container_tag = f"bootc-image-builder-test:{digest[:12]}"
+    if os.environ.get("BIB_TEST_REUSE_CONTAINER"):
+        if subprocess.run(["podman", "image", "exists", container_tag], check=False).returncode == 0:
+            return container_tag
+    testutil.run_quiet([
         "podman", "build",
         "-f", "Containerfile",
         "-t", container_tag,
     ])
+    remove_stale_test_containers(container_tag)
     return container_tag
 
 
-# image types to test
-SUPPORTED_IMAGE_TYPES = ["qcow2", "ami"]
+@pytest.fixture(name="shared_store", scope="session")
+def shared_store_fixture():
+    """Create a store volume that is shared between all image builds
+    so that the bootc container is only pulled once per test session"""
+    volume_name = f"bootc-image-builder-test-store-{uuid.uuid4().hex[:12]}"
+    subprocess.check_call(["podman", "volume", "create", volume_name], stdout=subprocess.DEVNULL)
+    yield volume_name
+    subprocess.run(["podman", "volume", "rm", "--force", volume_name], check=False, stdout=subprocess.DEVNULL)
+
+
+# image types to test and where bib puts their artifact inside the output dir
+ARTIFACT_SUBPATHS = {
+    "qcow2": ("qcow2", "disk.qcow2"),
+    "ami": ("image", "disk.raw"),
+}
+SUPPORTED_IMAGE_TYPES = list(ARTIFACT_SUBPATHS)
+
+
+# user that is created in the test images
+TEST_USERNAME = "test"
+TEST_PASSWORD = "password"
+
+# config.json passed to bib for every image build
+BUILD_CONFIG = {
+    "blueprint": {
+        "customizations": {
+            "user": [
+                {
+                    "name": TEST_USERNAME,
+                    "password": TEST_PASSWORD,
+                    "groups": ["wheel"],
+                },
+            ],
+        },
+    },
+}
 
 
-class ImageBuildResult(NamedTuple):
-    img_path: str
+@dataclass(slots=True, frozen=True)
+class ImageBuildResult:
+    img_path: pathlib.Path
     username: str
     password: str
-    journal_output: str
+    journal_log_path: pathlib.Path
+    output_path: pathlib.Path
 
 
 @pytest.fixture(name="image_type", scope="session")
-def image_type_fixture(tmpdir_factory, build_container, request):
+def image_type_fixture(tmp_path_factory, build_container, shared_store, request):
     """
     Build an image inside the passed build_container and return an
     ImageBuildResult with the resulting image path and user/password
@@ -56,89 +113,82 @@ def image_type_fixture(tmpdir_factory, build_container, request):
     # image_type is passed via special pytest parameter fixture
     image_type = request.param
 
-    username = "test"
-    password = "password"
-
-    output_path = pathlib.Path(tmpdir_factory.mktemp("data")) / "output"
-    output_path.mkdir(exist_ok=True)
+    output_path = tmp_path_factory.mktemp("data") / "output"
+    output_path.mkdir()
 
     journal_log_path = output_path / "journal.log"
-    artifact = {
-        "qcow2": pathlib.Path(output_path) / "qcow2/disk.qcow2",
-        "ami": pathlib.Path(output_path) / "image/disk.raw",
-    }
-    assert len(artifact) == len(SUPPORTED_IMAGE_TYPES), \
-        "please keep artifact mapping and supported images in sync"
-    generated_img = artifact[image_type]
+    generated_img = output_path.joinpath(*ARTIFACT_SUBPATHS[image_type])
 
     # if the fixture already ran and generated an image, use that
     if generated_img.exists():
-        journal_output = journal_log_path.read_text(encoding="utf8")
-        return ImageBuildResult(generated_img, username, password, journal_output)
+        return ImageBuildResult(generated_img, TEST_USERNAME, TEST_PASSWORD, journal_log_path, output_path)
 
     # no image yet, build it
-    CFG = {
-        "blueprint": {
-            "customizations": {
-                "user": [
-                    {
-                        "name": username,
-                        "password": password,
-                        "groups": ["wheel"],
-                    },
-                ],
-            },
-        },
-    }
-
     config_json_path = output_path / "config.json"
-    config_json_path.write_text(json.dumps(CFG), encoding="utf-8")
+    with config_json_path.open("w", encoding="utf-8") as fp:
+        json.dump(BUILD_CONFIG, fp)
 
-    cursor = testutil.journal_cursor()
     # run container to deploy an image into output/qcow2/disk.qcow2
-    subprocess.check_call([
-        "podman", "run", "--rm",
-        "--privileged",
-        "--security-opt", "label=type:unconfined_t",
-        "-v", f"{output_path}:/output",
-        "-v", "/store",  # share the cache between builds
-        build_container,
-        "quay.io/centos-bootc/fedora-bootc:eln",
-        "--config", "/output/config.json",
-        "--type", image_type,
-    ])
-    journal_output = testutil.journal_after_cursor(cursor)
-    journal_log_path.write_text(journal_output, encoding="utf8")
-
-    return ImageBuildResult(generated_img, username, password, journal_output)
+    with testutil.journal_stream(journal_log_path):
+        testutil.run_quiet([
+            "podman", "run", "--rm",
+            "--privileged",
+            "--security-opt", "label=type:unconfined_t",
+            "-v", f"{output_path}:/output",
+            "-v", f"{shared_store}:/store",  # share the cache between builds
+            build_container,
+            "quay.io/centos-bootc/fedora-bootc:eln",
+            "--config", "/output/config.json",
+            "--type", image_type,
+        ])
+
+    return ImageBuildResult(generated_img, TEST_USERNAME, TEST_PASSWORD, journal_log_path, output_path)
 
 
 def test_container_builds(build_container):
     output = subprocess.check_output([
-        "podman", "images", "-n", build_container], encoding="utf-8")
+        "podman", "images", "-n", "--format={{.Repository}}:{{.Tag}}", build_container,
+    ], encoding="utf-8")
     assert build_container in output
 
 
 @pytest.mark.parametrize("image_type", SUPPORTED_IMAGE_TYPES, indirect=["image_type"])
 def test_image_is_generated(image_type):
     assert image_type.img_path.exists(), "output file missing, dir "\
-        f"content: {os.listdir(os.fspath(image_type.img_path))}"
+        f"content: {os.listdir(image_type.output_path)}"
 
 
 @pytest.mark.skipif(platform.system() != "Linux", reason="boot test only runs on linux right now")
 @pytest.mark.parametrize("image_type", SUPPORTED_IMAGE_TYPES, indirect=["image_type"])
 def test_image_boots(image_type):
     with VM(image_type.img_path) as test_vm:
-        exit_status, _ = test_vm.run("true", user=image_type.username, password=image_type.password)
-        assert exit_status == 0
-        exit_status, output = test_vm.run("echo hello", user=image_type.username, password=image_type.password)
-        assert exit_status == 0
-        assert "hello" in output
+        results = test_vm.run_many(["true", "echo hello"], user=image_type.username, password=image_type.password)
+        assert [exit_status for exit_status, _ in results] == [0, 0]
+        assert "hello" in results[1][1]
 
 
-def log_has_osbuild_selinux_denials(log):
-    OSBUID_SELINUX_DENIALS_RE = re.compile(r"(?ms)avc:\ +denied.*osbuild")
-    return re.search(OSBUID_SELINUX_DENIALS_RE, log)
+SELINUX_DENIAL_RE = re.compile(r"avc:\ +denied")
+
+
+def log_has_osbuild_selinux_denials(log_lines):
+    """
+    Return a (denial line, osbuild line) tuple for the first selinux
+    denial that is followed by osbuild output, None if there is none
+    """
+    # a denial counts if "osbuild" shows up anywhere after it, the denied
+    # comm is often a stage helper like setfiles, mount, bwrap or rpm
+    denial = None
+    for line in log_lines:
+        search_from = 0
+        if denial is None:
+            m = SELINUX_DENIAL_RE.search(line)
+            if not m:
+                continue
+            denial = line
+            search_from = m.end()
+        if "osbuild" in line[search_from:]:
+            return denial.rstrip("\n"), line.rstrip("\n")
+    return None
 
 
 def test_osbuild_selinux_denials_re_works():
@@ -154,18 +204,31 @@ def test_osbuild_selinux_denials_re_works():
         'c516,c631 tcontext=system_u:system_r:mount_t:s0:c516,c631 '
         'tclass=process2 permissive=0'
     )
-    assert log_has_osbuild_selinux_denials(fake_log)
-    assert not log_has_osbuild_selinux_denials("some\nrandom\nlogs")
+    assert log_has_osbuild_selinux_denials(fake_log.splitlines())
+    assert not log_has_osbuild_selinux_denials("some\nrandom\nlogs".splitlines())
+    # denial from a non-osbuild comm that is followed by osbuild output
+    fake_log = (
+        'Dec 06 16:00:54 internal audit[14368]: AVC avc:  denied '
+        '{ relabelto } for  pid=14368 comm="setfiles" '
+        'scontext=system_u:system_r:setfiles_t:s0 tclass=file permissive=0\n'
+        'Dec 06 16:00:55 internal osbuild[14300]: org.osbuild.selinux failed\n'
+    )
+    assert log_has_osbuild_selinux_denials(fake_log.splitlines()) == tuple(fake_log.splitlines())
+    # osbuild output before a denial does not count
+    assert not log_has_osbuild_selinux_denials(reversed(fake_log.splitlines()))
 
 
 def has_selinux():
-    return testutil.has_executable("selinuxenabled") and subprocess.run("selinuxenabled").returncode == 0
+    # /usr/sbin is not always in $PATH, so run the path that was found
+    selinuxenabled = testutil.find_executable("selinuxenabled")
+    return selinuxenabled is not None and subprocess.run([selinuxenabled], check=False).returncode == 0
 
 
 @pytest.mark.skipif(not has_selinux(), reason="selinux not enabled")
 @pytest.mark.parametrize("image_type", SUPPORTED_IMAGE_TYPES, indirect=["image_type"])
 def test_image_build_without_se_linux_denials(image_type):
     # the journal always contains logs from the image building
-    assert image_type.journal_output != ""
-    assert not log_has_osbuild_selinux_denials(image_type.journal_output), \
-        f"denials in log {image_type.journal_output}"
+    assert image_type.journal_log_path.stat().st_size > 0
+    with image_type.journal_log_path.open(encoding="utf8") as fp:
+        denial = log_has_osbuild_selinux_denials(fp)
+    assert denial is None, "denials in log:\n" + "\n".join(denial)
@@ -1,33 +1,155 @@
+import contextlib
+import functools
+import hashlib
 import os
 import pathlib
 import platform
+import selectors
 import socket
 import shutil
 import subprocess
+import sys
 import time
+import uuid
 
 
-def run_journalctl(*args):
+@functools.cache
+def _system():
+    return platform.system()
+
+
+def host_cmd(*cmd):
+    """Return cmd so that it runs on the host that runs the containers"""
     pre = []
-    if platform.system() == "Darwin":
+    if _system() == "Darwin":
         pre = ["podman", "machine", "ssh"]
-    cmd = pre + ["journalctl"] + list(args)
-    return subprocess.check_output(cmd, encoding="utf-8").strip()
+    return pre + list(cmd)
+
+
+def journalctl_cmd(*args):
+    return host_cmd("journalctl", *args)
+
+
+def _sync_journal_stream(path, p, timeout=60):
+    """
+    Log marker messages until one of them shows up in the journal
+    stream that process p writes to path. Once it did, everything that
+    was logged before the marker is in path as well.
+    """
+    token = f"bib-test-sync-{uuid.uuid4().hex}".encode()
+    deadline = time.monotonic() + timeout
+    with open(path, "rb") as fp:
+        seen = b""
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            # keep logging new markers, a follower that is still starting
+            # up will not see the ones logged before it was ready
+            subprocess.check_call(host_cmd("logger", "-t", "bib-test", f"{token.decode()} {n}"))
+            retry_at = min(deadline, time.monotonic() + 1)
+            while time.monotonic() < retry_at:
+                chunk = fp.read(65536)
+                if chunk:
+                    seen = seen[-len(token):] + chunk
+                    if token in seen:
+                        return
+                    continue
+                if p.poll() is not None:
+                    raise RuntimeError(f"journalctl exited with {p.returncode}")
+                time.sleep(0.05)
+    raise TimeoutError(f"journal marker did not show up in {path} after {timeout}s")
+
+
+@contextlib.contextmanager
+def journal_stream(path):
+    """
+    Write all journal entries that appear while the context is active
+    into path, using a single "journalctl --follow" process. The output
+    is streamed directly into the file and never held in memory.
+    """
+    with open(path, "wb") as fp:
+        p = subprocess.Popen(journalctl_cmd("--follow", "--lines=0"), stdout=fp)
+        try:
+            # journalctl follows asynchronously and journald ingests e.g.
+            # kernel audit records asynchronously too, so sync on markers
+            # before and after the body to not lose any entries
+            _sync_journal_stream(path, p)
+            yield
+            _sync_journal_stream(path, p)
+        finally:
+            p.terminate()
+            p.wait()
 
 
-def journal_cursor():
-    output = run_journalctl("-n0", "--show-cursor")
-    cursor = output.split("\n")[-1]
-    return cursor.split("cursor: ")[-1]
+def run_quiet(cmd):
+    """
+    Run cmd with its stdout and stderr captured into a single stream,
+    the tail of that output is only shown when the command fails. Set
+    BIB_TEST_VERBOSE to see all the output while the command runs.
+    """
+    if os.environ.get("BIB_TEST_VERBOSE"):
+        subprocess.check_call(cmd)
+        return
+    # osbuild logs its stages (and the traceback of a failed one) and
+    # podman build its steps to stdout, so keep both streams
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+    if res.returncode != 0:
+        tail = res.stdout[-64 * 1024:].decode("utf-8", "replace")
+        sys.stderr.write(tail)
+        raise subprocess.CalledProcessError(res.returncode, cmd, output=tail)
 
 
-def journal_after_cursor(cursor):
-    output = run_journalctl(f"--after-cursor={cursor}")
-    return output
+def container_build_digest(containerfile, context="."):
+    """
+    Return a sha256 hex digest over the containerfile and all the files
+    from the build context that it COPYs/ADDs
+    """
+    containerfile = pathlib.Path(containerfile)
+    context = pathlib.Path(context)
+    paths = [containerfile]
+    for line in containerfile.read_text(encoding="utf8").splitlines():
+        words = line.split()
+        if not words or words[0].upper() not in ("COPY", "ADD"):
+            continue
+        # copies from other build stages are covered by their inputs
+        if any(w.startswith("--from") for w in words):
+            continue
+        for src in words[1:-1]:
+            if src.startswith("--"):
+                continue
+            src = os.path.normpath(src)
+            # "COPY . /dst" copies the whole context, glob(".") is an error
+            matches = [context] if src == "." else sorted(context.glob(src))
+            for p in matches:
+                if p.is_dir():
+                    paths.extend(sorted(f for f in p.rglob("*") if f.is_file()))
+                else:
+                    paths.append(p)
+    digest = hashlib.sha256()
+    for p in paths:
+        digest.update(os.fspath(p).encode("utf8"))
+        digest.update(p.read_bytes())
+    return digest.hexdigest()
+
+
+# well-known locations that are checked before searching $PATH
+KNOWN_EXECUTABLE_PATHS = {
+    "podman": ("/usr/bin/podman", "/usr/local/bin/podman"),
+    "selinuxenabled": ("/usr/sbin/selinuxenabled",),
+}
+
+
+@functools.cache
+def find_executable(name):
+    """Return the full path of the executable name or None"""
+    for p in KNOWN_EXECUTABLE_PATHS.get(name, ()):
+        if os.access(p, os.X_OK):
+            return p
+    return shutil.which(name)
 
 
 def has_executable(name):
-    return shutil.which(name) is not None
+    return find_executable(name) is not None
 
 
 def get_free_port() -> int:
@@ -37,30 +159,107 @@ def get_free_port() -> int:
         return s.getsockname()[1]
 
 
-def wait_ssh_ready(port, sleep, max_wait_sec):
-    for i in range(int(max_wait_sec / sleep)):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(sleep)
-            try:
-                s.connect(("localhost", port))
-                data = s.recv(256)
-                if b"OpenSSH" in data:
-                    return
-            except (ConnectionRefusedError, ConnectionResetError, TimeoutError):
-                pass
-            time.sleep(sleep)
-    raise ConnectionRefusedError(f"cannot connect to port {port} after {max_wait_sec}s")
+def wait_ssh_ready(port, sleep, max_wait_sec, min_sleep=0.05):
+    wait_ssh_ready_many([("localhost", port)], sleep, max_wait_sec, min_sleep)
+
+
+def wait_ssh_ready_many(addrs, sleep, max_wait_sec, min_sleep=0.05):
+    """
+    Wait until an ssh server answers on all the given (host, port)
+    addrs. All connection attempts are multiplexed on a single
+    selector. Each address is polled quickly at first and backs off
+    exponentially up to "sleep".
+    """
+    deadline = time.monotonic() + max_wait_sec
+    pending = set(addrs)
+    attempts = dict.fromkeys(addrs, 0)
+    # addrs without a connection attempt in flight and when to retry them
+    retry_at = dict.fromkeys(addrs, 0.0)
+    with selectors.DefaultSelector() as sel:
+
+        def finish_attempt(s, addr, retry):
+            sel.unregister(s)
+            s.close()
+            if retry is not None:
+                retry_at[addr] = retry
+
+        try:
+            while pending and (now := time.monotonic()) < deadline:
+                for addr in [a for a, t in retry_at.items() if t <= now]:
+                    del retry_at[addr]
+                    # cap the exponent, 1.5 ** n overflows a float for long waits
+                    cur_sleep = min(sleep, min_sleep * 1.5 ** min(attempts[addr], 64))
+                    attempts[addr] += 1
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    s.setblocking(False)
+                    s.connect_ex(addr)
+                    # key data is (addr, cur_sleep, deadline of this step, banner so far)
+                    sel.register(s, selectors.EVENT_WRITE, (addr, cur_sleep, now + cur_sleep, b""))
+                keys = list(sel.get_map().values())
+                wake_at = min([deadline, *retry_at.values(), *(key.data[2] for key in keys)])
+                ready = {key.fileobj for key, _ in sel.select(timeout=wake_at - now)}
+                now = time.monotonic()
+                for key in keys:
+                    s = key.fileobj
+                    addr, cur_sleep, step_deadline, banner = key.data
+                    if s not in ready:
+                        if now >= step_deadline:
+                            # we already waited "cur_sleep", retry right away
+                            finish_attempt(s, addr, now)
+                        continue
+                    if key.events == selectors.EVENT_WRITE:
+                        if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                            # connected, now wait for the banner
+                            sel.modify(s, selectors.EVENT_READ, (addr, cur_sleep, now + cur_sleep, b""))
+                            continue
+                    else:
+                        try:
+                            data = s.recv(1024)
+                        except ConnectionResetError:
+                            data = b""
+                        banner += data
+                        # any ssh server identifies itself with "SSH-", see RFC 4253
+                        if banner.startswith(b"SSH-"):
+                            pending.discard(addr)
+                            finish_attempt(s, addr, None)
+                            continue
+                        if data and b"SSH-".startswith(banner):
+                            # banner arrived fragmented, wait for the rest
+                            sel.modify(s, selectors.EVENT_READ, (addr, cur_sleep, step_deadline, banner))
+                            continue
+                    # failed fast (refused, wrong banner), wait before retrying
+                    finish_attempt(s, addr, now + cur_sleep)
+        finally:
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+    if pending:
+        not_ready = ", ".join(f"{host}:{port}" for host, port in sorted(pending))
+        raise ConnectionRefusedError(f"cannot connect to {not_ready} after {max_wait_sec}s")
 
 
+@functools.cache
 def has_x86_64_v3_cpu():
     # x86_64-v3 has multiple features, see
     # https://en.wikipedia.org/wiki/X86-64#Microarchitecture_levels
     # but "avx2" is probably a good enough proxy
-    return " avx2 " in pathlib.Path("/proc/cpuinfo").read_text()
+    fd = os.open("/proc/cpuinfo", os.O_RDONLY)
+    try:
+        # all cpus have the same flags, so the first processor block is
+        # enough, it ends with an empty line
+        buf = b""
+        while b"\n\n" not in buf and (chunk := os.read(fd, 4096)):
+            buf += chunk
+    finally:
+        os.close(fd)
+    for line in buf.split(b"\n\n", 1)[0].splitlines():
+        if line.startswith(b"flags"):
+            return b"avx2" in line.split()
+    return False
 
 
+@functools.cache
 def can_start_rootful_containers():
-    match platform.system():
+    match _system():
         case "Linux":
             # on linux we need to run "podman" with sudo to get full
             # root containers
@@ -71,7 +270,7 @@ def can_start_rootful_containers():
             # as it's just proxying to the VM
             res = subprocess.run([
                 "podman", "machine", "inspect", "--format={{.Rootful}}",
-            ], capture_output=True, encoding="utf8", check=True)
+            ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding="utf8", check=True)
             return res.stdout.strip() == "true"
         case unknown:
             raise ValueError(f"unknown platform {unknown}")
@@ -1,11 +1,18 @@
 import contextlib
+import os
 import platform
+import socket
 import subprocess
-from unittest.mock import call, patch
+import threading
+import time
+from unittest.mock import patch
 
 import pytest
 
-from testutil import has_executable, get_free_port, wait_ssh_ready
+from testutil import (
+    KNOWN_EXECUTABLE_PATHS, container_build_digest, find_executable, has_executable, get_free_port, run_quiet,
+    wait_ssh_ready, wait_ssh_ready_many,
+)
 
 
 def test_get_free_port():
@@ -13,47 +20,151 @@ def test_get_free_port():
     assert port_nr > 1024 and port_nr < 65535
 
 
+def test_find_executable_known_path_not_in_path(tmp_path, monkeypatch):
+    exe = tmp_path / "selinuxenabled"
+    exe.write_text("#!/bin/sh\n", encoding="utf8")
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", "/nonexistent")
+    monkeypatch.setitem(KNOWN_EXECUTABLE_PATHS, "fake-selinuxenabled", (os.fspath(exe),))
+    assert find_executable("fake-selinuxenabled") == os.fspath(exe)
+    assert has_executable("fake-selinuxenabled")
+    assert find_executable("no-such-executable") is None
+
+
+def test_container_build_digest(tmp_path):
+    containerfile = tmp_path / "Containerfile"
+    containerfile.write_text(
+        "FROM scratch AS builder\n"
+        "COPY src /build/src\n"
+        "FROM scratch\n"
+        "COPY --from=builder /build/src /src\n"
+        "COPY ./entrypoint.sh /\n", encoding="utf8")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.go").write_text("package main", encoding="utf8")
+    (tmp_path / "entrypoint.sh").write_text("#!/bin/sh", encoding="utf8")
+    (tmp_path / "unrelated").write_text("not copied", encoding="utf8")
+
+    digest = container_build_digest(containerfile, tmp_path)
+    assert len(digest) == 64
+    (tmp_path / "unrelated").write_text("changed", encoding="utf8")
+    assert container_build_digest(containerfile, tmp_path) == digest
+    (tmp_path / "src" / "main.go").write_text("package other", encoding="utf8")
+    assert container_build_digest(containerfile, tmp_path) != digest
+    digest = container_build_digest(containerfile, tmp_path)
+    (tmp_path / "entrypoint.sh").write_text("#!/bin/bash", encoding="utf8")
+    assert container_build_digest(containerfile, tmp_path) != digest
+
+
+def test_container_build_digest_whole_context(tmp_path):
+    containerfile = tmp_path / "Containerfile"
+    containerfile.write_text("FROM scratch\nCOPY ./ /src\n", encoding="utf8")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "file").write_text("content", encoding="utf8")
+
+    digest = container_build_digest(containerfile, tmp_path)
+    (tmp_path / "sub" / "file").write_text("changed", encoding="utf8")
+    assert container_build_digest(containerfile, tmp_path) != digest
+
+
+def test_run_quiet(capfd, monkeypatch):
+    monkeypatch.delenv("BIB_TEST_VERBOSE", raising=False)
+    run_quiet(["sh", "-c", "echo out; echo err >&2"])
+    assert capfd.readouterr() == ("", "")
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        run_quiet(["sh", "-c", "echo out; echo err >&2; exit 3"])
+    assert e.value.returncode == 3
+    assert e.value.output == "out\nerr\n"
+    assert capfd.readouterr() == ("", "out\nerr\n")
+
+
 @pytest.fixture(name="free_port")
 def free_port_fixture():
     return get_free_port()
 
 
-@patch("time.sleep")
-def test_wait_ssh_ready_sleeps_no_connection(mocked_sleep, free_port):
-    with pytest.raises(ConnectionRefusedError):
-        wait_ssh_ready(free_port, sleep=0.1, max_wait_sec=0.35)
-    assert mocked_sleep.call_args_list == [call(0.1), call(0.1), call(0.1)]
+def test_wait_ssh_ready_sleeps_no_connection(free_port):
+    with patch("selectors.DefaultSelector.select") as mocked_select:
+        # pretend nothing ever becomes ready, just let the time pass
+        mocked_select.side_effect = lambda timeout: time.sleep(max(timeout, 0)) or []
+        with pytest.raises(ConnectionRefusedError):
+            wait_ssh_ready(free_port, sleep=0.1, max_wait_sec=0.35)
+    # the exact number of attempts depends on scheduling
+    assert 3 <= mocked_select.call_count <= 8
+    timeouts = [c.kwargs["timeout"] for c in mocked_select.call_args_list]
+    # backoff starts at 50ms and is capped by "sleep"
+    assert timeouts[:3] == pytest.approx([0.05, 0.075, 0.1], abs=0.01)
+    assert max(timeouts) == pytest.approx(0.1, abs=0.01)
 
 
+@pytest.mark.skipif(platform.system() == "Darwin", reason="hangs on macOS")
 @pytest.mark.skipif(not has_executable("nc"), reason="needs nc")
-def test_wait_ssh_ready_sleeps_wrong_reply(free_port, tmp_path):
+def test_wait_ssh_ready_integration(free_port, tmp_path):
     with contextlib.ExitStack() as cm:
         p = subprocess.Popen(
-            f"echo not-ssh | nc -vv -l -p {free_port}",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            encoding="utf-8",
-        )
+            ["nc", "-l", "-p", str(free_port)], stdin=subprocess.PIPE, encoding="utf-8")
         cm.callback(p.kill)
-        # wait for nc to be ready
+        p.stdin.write("SSH-2.0-OpenSSH_9.6\r\n")
+        p.stdin.close()
+        wait_ssh_ready(free_port, sleep=0.1, max_wait_sec=10)
+
+
+def fake_sshd(cm, banner, fragmented=False, connections=None):
+    """
+    Listen on a free port and answer every connection with banner, the
+    peer address of each connection is appended to connections if given
+    """
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    cm.callback(srv.close)
+    srv.bind(("localhost", 0))
+    srv.listen()
+
+    def serve():
         while True:
-            # netcat tranditional uses "listening", others "Listening"
-            # so just omit the first char
-            if "istening " in p.stdout.readline():
-                break
-        # now connect
-        with patch("time.sleep") as mocked_sleep:
-            with pytest.raises(ConnectionRefusedError):
-                wait_ssh_ready(free_port, sleep=0.1, max_wait_sec=0.55)
-            assert mocked_sleep.call_args_list == [
-                call(0.1), call(0.1), call(0.1), call(0.1), call(0.1)]
+            try:
+                conn, peer = srv.accept()
+            except OSError:
+                return
+            if connections is not None:
+                connections.append(peer)
+            with conn:
+                if fragmented:
+                    conn.sendall(banner[:2])
+                    time.sleep(0.05)
+                    banner_rest = banner[2:]
+                else:
+                    banner_rest = banner
+                conn.sendall(banner_rest)
+    threading.Thread(target=serve, daemon=True).start()
+    return srv.getsockname()[1]
 
 
-@pytest.mark.skipif(platform.system() == "Darwin", reason="hangs on macOS")
-@pytest.mark.skipif(not has_executable("nc"), reason="needs nc")
-def test_wait_ssh_ready_integration(free_port, tmp_path):
+def test_wait_ssh_ready_sleeps_wrong_reply():
+    connections = []
     with contextlib.ExitStack() as cm:
-        p = subprocess.Popen(f"echo OpenSSH | nc -l -p {free_port}", shell=True)
-        cm.callback(p.kill)
-        wait_ssh_ready(free_port, sleep=0.1, max_wait_sec=10)
+        port = fake_sshd(cm, b"not-ssh\n", connections=connections)
+        # each failed attempt still waits with a backoff (50ms, 75ms,
+        # 100ms, 100ms, ...) before retrying so we do not busy loop
+        start = time.monotonic()
+        with pytest.raises(ConnectionRefusedError):
+            wait_ssh_ready(port, sleep=0.1, max_wait_sec=0.55)
+        assert time.monotonic() - start >= 0.5
+    # the backoff allows 7 attempts in 0.55s, a busy loop would do many more
+    assert 3 <= len(connections) <= 8
+
+
+def test_wait_ssh_ready_many(free_port):
+    with contextlib.ExitStack() as cm:
+        ssh_port1 = fake_sshd(cm, b"SSH-2.0-OpenSSH_9.6\r\n")
+        ssh_port2 = fake_sshd(cm, b"SSH-2.0-OpenSSH_9.6\r\n")
+        wrong_port = fake_sshd(cm, b"not-ssh\n")
+        dropbear_port = fake_sshd(cm, b"SSH-2.0-dropbear_2022.83\r\n", fragmented=True)
+        wait_ssh_ready_many(
+            [("localhost", ssh_port1), ("localhost", ssh_port2), ("localhost", dropbear_port)],
+            sleep=0.1, max_wait_sec=10)
+        with pytest.raises(ConnectionRefusedError) as e:
+            wait_ssh_ready_many(
+                [("localhost", ssh_port1), ("localhost", free_port), ("localhost", wrong_port)],
+                sleep=0.1, max_wait_sec=0.3)
+        assert f"localhost:{ssh_port1}" not in str(e.value)
+        assert f"localhost:{free_port}" in str(e.value)
+        assert f"localhost:{wrong_port}" in str(e.value)
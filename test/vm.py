@@ -1,7 +1,10 @@
+import codecs
 import pathlib
+import re
 import subprocess
 import sys
-from io import StringIO
+import threading
+import uuid
 
 from testutil import get_free_port, wait_ssh_ready
 
@@ -9,25 +12,34 @@ from testutil import get_free_port, wait_ssh_ready
 from paramiko.client import AutoAddPolicy, SSHClient
 
 
+def _drain(src, log_path):
+    """Copy everything from the src pipe to log_path in large chunks"""
+    with src, open(log_path, "ab") as log:
+        while chunk := src.read1(65536):
+            log.write(chunk)
+            log.flush()
+
+
 class VM:
     MEM = "2000"
     # TODO: support qemu-system-aarch64 too :)
     QEMU = "qemu-system-x86_64"
+    START_ATTEMPTS = 5
 
     def __init__(self, img, snapshot=True):
         self._img = pathlib.Path(img)
         self._qemu_p = None
         self._ssh_port = None
         self._snapshot = snapshot
+        # connected ssh clients, keyed by (port, user)
+        self._ssh_clients = {}
+        # results of VM.run(..., cache=True), keyed by (cmd, user, pty)
+        self._run_cache = {}
 
     def __del__(self):
         self.force_stop()
 
-    def start(self):
-        if self._qemu_p is not None:
-            return
-        log_path = self._img.with_suffix(".serial-log")
-        self._ssh_port = get_free_port()
+    def _qemu_cmdline(self, ssh_port):
         qemu_cmdline = [
             self.QEMU, "-enable-kvm",
             "-m", self.MEM,
@@ -36,29 +48,83 @@ class VM:
             "-nographic",
             "-serial", "stdio",
             "-monitor", "none",
-            "-netdev", f"user,id=net.0,hostfwd=tcp::{self._ssh_port}-:22",
+            "-netdev", f"user,id=net.0,hostfwd=tcp::{ssh_port}-:22",
             "-device", "rtl8139,netdev=net.0",
         ]
         if self._snapshot:
             qemu_cmdline.append("-snapshot")
         qemu_cmdline.append(self._img)
-        self._log(f"vm starting, log available at {log_path}")
+        return qemu_cmdline
 
-        # XXX: use systemd-run to ensure cleanup?
-        self._qemu_p = subprocess.Popen(
-            qemu_cmdline, stdout=sys.stdout, stderr=sys.stderr)
-        # XXX: also check that qemu is working and did not crash
-        self.wait_ssh_ready()
+    def start(self):
+        if self._qemu_p is not None:
+            return
+        log_path = self._img.with_suffix(".serial-log")
+        self._log(f"vm starting, log available at {log_path}")
+        try:
+            self._start_qemu(log_path)
+            # XXX: also check that qemu is working and did not crash
+            self.wait_ssh_ready()
+        except Exception:
+            # the serial log lives in the tmp dir that is gone after a
+            # CI run, so show the end of it in the test output
+            self._write_log_tail(log_path)
+            raise
         self._log(f"vm ready at port {self._ssh_port}")
 
+    def _start_qemu(self, log_path):
+        for _ in range(self.START_ATTEMPTS):
+            # get_free_port() is racy, if the port got taken before qemu
+            # could bind it qemu exits right away and we try a new port
+            self._ssh_port = get_free_port()
+            log_offset = log_path.stat().st_size if log_path.exists() else 0
+            # XXX: use systemd-run to ensure cleanup?
+            self._qemu_p = subprocess.Popen(
+                self._qemu_cmdline(self._ssh_port),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1 << 16)
+            drain = threading.Thread(
+                target=_drain, args=(self._qemu_p.stdout, log_path), daemon=True)
+            drain.start()
+            try:
+                self._qemu_p.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                return
+            drain.join()
+            returncode = self._qemu_p.returncode
+            self._qemu_p = None
+            with open(log_path, "rb") as log:
+                log.seek(log_offset)
+                output = log.read().decode("utf-8", "replace")
+            if "Could not set up host forwarding rule" not in output:
+                raise RuntimeError(f"qemu exited with {returncode}, see {log_path}")
+            self._log(f"qemu could not bind port {self._ssh_port}, see {log_path}, retrying")
+        raise RuntimeError(f"cannot start qemu after {self.START_ATTEMPTS} attempts")
+
+    def _write_log_tail(self, log_path, size=64 * 1024):
+        if not log_path.exists():
+            return
+        with open(log_path, "rb") as log:
+            log.seek(max(log_path.stat().st_size - size, 0))
+            tail = log.read().decode("utf-8", "replace")
+        self._log(f"--- last {len(tail)} chars of {log_path} ---")
+        self._write(tail)
+        self._log("--- end of serial log ---")
+
     def _log(self, msg):
+        self._write(msg.rstrip("\n") + "\n")
+
+    def _write(self, text):
         # XXX: use a proper logger
-        sys.stdout.write(msg.rstrip("\n") + "\n")
+        sys.stdout.write(text)
 
     def wait_ssh_ready(self):
         wait_ssh_ready(self._ssh_port, sleep=1, max_wait_sec=600)
 
     def force_stop(self):
+        for client in self._ssh_clients.values():
+            client.close()
+        self._ssh_clients.clear()
+        self._run_cache.clear()
         if self._qemu_p:
             self._qemu_p.kill()
             self._qemu_p = None
@@ -70,24 +136,63 @@ class VM:
     def __exit__(self, type, value, tb):
         self.force_stop()
 
-    def run(self, cmd, user, password):
+    def _ssh_client(self, user, password):
+        key = (self._ssh_port, user)
+        client = self._ssh_clients.get(key)
+        transport = client.get_transport() if client else None
+        if transport is None or not transport.is_active():
+            client = SSHClient()
+            client.set_missing_host_key_policy(AutoAddPolicy)
+            client.connect(
+                "localhost", self._ssh_port, user, password,
+                allow_agent=False, look_for_keys=False)
+            client.get_transport().set_keepalive(30)
+            self._ssh_clients[key] = client
+        return client
+
+    def run(self, cmd, user, password, pty=False, cache=False):
+        # cache=True reuses the result of an earlier identical run, only
+        # use it for read-only commands like "cat /etc/os-release"
+        if cache and (cmd, user, pty) in self._run_cache:
+            return self._run_cache[(cmd, user, pty)]
         if not self._qemu_p:
             self.start()
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy)
-        client.connect(
-            "localhost", self._ssh_port, user, password,
-            allow_agent=False, look_for_keys=False)
+        client = self._ssh_client(user, password)
         chan = client.get_transport().open_session()
-        chan.get_pty()
+        if pty:
+            chan.get_pty()
+        else:
+            # without a pty stderr is a separate stream, merge it so that
+            # the output is complete and stderr cannot stall the channel
+            chan.set_combine_stderr(True)
         chan.exec_command(cmd)
-        stdout_f = chan.makefile()
-        output = StringIO()
-        while True:
-            out = stdout_f.readline()
-            if not out:
-                break
-            self._log(out)
-            output.write(out)
-        exit_status = stdout_f.channel.recv_exit_status()
-        return exit_status, output.getvalue()
+        # utf-8 sequences can be split across recv() chunks
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        chunks = []
+        while data := chan.recv(65536):
+            text = decoder.decode(data)
+            self._write(text)
+            chunks.append(text)
+        chunks.append(decoder.decode(b"", final=True))
+        exit_status = chan.recv_exit_status()
+        result = exit_status, "".join(chunks)
+        if cache:
+            self._run_cache[(cmd, user, pty)] = result
+        return result
+
+    def run_many(self, cmds, user, password):
+        """
+        Run all cmds one after another in a single remote shell and
+        return a list of (exit_status, output) tuples, one per cmd
+        """
+        sep = f"__BIB_SEP_{uuid.uuid4().hex}__"
+        script = "".join(f"{cmd}\nprintf '\\n{sep} %d\\n' $?\n" for cmd in cmds)
+        exit_status, output = self.run(script, user, password)
+        parts = re.split(rf"\r?\n{sep} (\d+)\r?\n", output)
+        results = [(int(status), out) for out, status in zip(parts[0::2], parts[1::2])]
+        if len(results) != len(cmds):
+            # a command ended the shell (e.g. "exit 3"), the rest never ran
+            raise RuntimeError(
+                f"shell exited with {exit_status} in {cmds[len(results)]!r}, "
+                f"output: {parts[-1]!r}")
+        return results
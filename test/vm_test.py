@@ -0,0 +1,90 @@
+import subprocess
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from vm import VM
+
+
+def run_locally(cmd, user, password):
+    res = subprocess.run(["sh", "-c", cmd], stdout=subprocess.PIPE, encoding="utf-8", check=False)
+    return res.returncode, res.stdout
+
+
+@patch.object(VM, "run", side_effect=run_locally)
+def test_run_many(mocked_run):
+    vm = VM("disk.qcow2")
+    results = vm.run_many(
+        ["true", "echo hello", "printf 'no newline'", "false", "echo a; echo b"],
+        user="user", password="password")
+    assert results == [
+        (0, ""),
+        (0, "hello\n"),
+        (0, "no newline"),
+        (1, ""),
+        (0, "a\nb\n"),
+    ]
+    # all commands went through a single run()
+    assert mocked_run.call_count == 1
+
+
+@patch.object(VM, "run", side_effect=run_locally)
+def test_run_many_shell_exits(_):
+    vm = VM("disk.qcow2")
+    with pytest.raises(RuntimeError, match=r"shell exited with 3 in 'exit 3'"):
+        vm.run_many(["echo a", "exit 3", "echo never"], user="user", password="password")
+
+
+def fake_qemu(output, exit_code=None):
+    def qemu_cmdline(self, ssh_port):
+        if exit_code is None:
+            # keep running like a booting vm
+            return ["sh", "-c", f"echo '{output}'; exec sleep 60"]
+        return ["sh", "-c", f"echo '{output}'; exit {exit_code}"]
+    return qemu_cmdline
+
+
+def test_start_retries_on_hostfwd_failure(tmp_path):
+    vm = VM(tmp_path / "disk.qcow2")
+    qemu_cmdline = fake_qemu("qemu-system-x86_64: Could not set up host forwarding rule 'tcp::1234-:22'", 1)
+    with patch.object(VM, "_qemu_cmdline", qemu_cmdline), patch("vm.get_free_port", return_value=1234) as mocked:
+        with pytest.raises(RuntimeError, match=f"cannot start qemu after {VM.START_ATTEMPTS} attempts"):
+            vm.start()
+    assert mocked.call_count == VM.START_ATTEMPTS
+
+
+def test_start_raises_on_other_failure(tmp_path, capsys):
+    vm = VM(tmp_path / "disk.qcow2")
+    qemu_cmdline = fake_qemu("qemu-system-x86_64: failed to initialize kvm", 1)
+    with patch.object(VM, "_qemu_cmdline", qemu_cmdline), patch("vm.get_free_port", return_value=1234) as mocked:
+        with pytest.raises(RuntimeError, match=r"qemu exited with 1, see .*disk\.serial-log"):
+            vm.start()
+    assert mocked.call_count == 1
+    # the serial log is shown in the test output
+    assert "failed to initialize kvm" in capsys.readouterr().out
+
+
+def test_start_shows_serial_log_when_ssh_never_ready(tmp_path, capsys):
+    vm = VM(tmp_path / "disk.qcow2")
+    qemu_cmdline = fake_qemu("kernel panic")
+    with patch.object(VM, "_qemu_cmdline", qemu_cmdline), \
+            patch.object(VM, "wait_ssh_ready", side_effect=ConnectionRefusedError("timeout")):
+        with pytest.raises(ConnectionRefusedError):
+            vm.start()
+    vm.force_stop()
+    assert "kernel panic" in capsys.readouterr().out
+
+
+def test_run_split_utf8(capsys):
+    vm = VM("disk.qcow2")
+    vm._qemu_p = MagicMock()
+    chan = MagicMock()
+    # "ü" is split across two recv() chunks
+    chan.recv.side_effect = [b"gr\xc3", b"\xbcn\n", b""]
+    chan.recv_exit_status.return_value = 0
+    client = MagicMock()
+    client.get_transport.return_value.open_session.return_value = chan
+    with patch.object(VM, "_ssh_client", return_value=client):
+        assert vm.run("echo grün", user="user", password="password") == (0, "grün\n")
+    assert capsys.readouterr().out == "grün\n"
+    vm._qemu_p = None